@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+#
+# Local stand-in for the Alpaca REST endpoints broker_alpaca's option path uses, and a latency check
+# that runs an account's driver against it:
+#
+#   python3 alpaca_standin.py <account> [n]
+#
+# Times n option quotes and n option orders through the driver's pooled session and reports the
+# first call (which opens the connection) against the rest, plus how many connections were opened.
+
+import asyncio
+import datetime
+import sys
+import time
+import uuid
+
+from aiohttp import web
+
+from broker_alpaca import broker_alpaca, alpaca_rest
+from event_log import get_event_log
+
+class alpaca_standin:
+    def __init__(self, ask=1.25, delay=0):
+        self.ask = ask
+        self.delay = delay
+        self.orders = {}
+        self.connections = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1beta1/options/quotes/latest', self.latest_quotes)
+        app.router.add_post('/v2/orders', self.submit_order)
+        app.router.add_get('/v2/orders/{id}', self.get_order)
+        return app
+
+    async def answer(self, request, body):
+        self.connections.add(id(request.transport))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.json_response(body)
+
+    async def latest_quotes(self, request):
+        quotes = {symbol: {'ap': self.ask, 'bp': self.ask - 0.05, 'as': 10, 'bs': 10, 't': datetime.datetime.utcnow().isoformat() + 'Z'}
+                  for symbol in request.query['symbols'].split(',')}
+        return await self.answer(request, {'quotes': quotes})
+
+    async def submit_order(self, request):
+        order = await request.json()
+        order.update({'id': str(uuid.uuid4()), 'status': 'accepted', 'filled_qty': '0', 'filled_avg_price': None})
+        self.orders[order['id']] = order
+        return await self.answer(request, order)
+
+    # every order fills at its limit the first time it's looked at
+    async def get_order(self, request):
+        order = self.orders[request.match_info['id']]
+        order.update({'status': 'filled', 'filled_qty': order['qty'], 'filled_avg_price': order['limit_price']})
+        return await self.answer(request, order)
+
+def summary(name, ms):
+    rest = sorted(ms[1:])
+    return f"{name:6} first {ms[0]:7.2f}ms  then p50 {rest[len(rest) // 2]:6.2f}ms  p99 {rest[int(len(rest) * 0.99)]:6.2f}ms"
+
+async def bench(account, n):
+    standin = alpaca_standin()
+    runner = web.AppRunner(standin.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    driver = broker_alpaca('live', account)
+    driver.rest = alpaca_rest('standin', 'standin', url, url)
+    expiry = datetime.date.today()
+
+    quote_ms = []
+    order_ms = []
+    for i in range(n):
+        start = time.perf_counter()
+        await driver.get_price_opt_async('SPY', expiry, 400, 'C')
+        quote_ms.append((time.perf_counter() - start) * 1000)
+    for i in range(n):
+        start = time.perf_counter()
+        await driver.buy_opt_async('SPY', expiry, 400, 'C', 1, 1.30)
+        order_ms.append((time.perf_counter() - start) * 1000)
+
+    await driver.rest.close()
+    await runner.cleanup()
+
+    print(summary('quote', quote_ms))
+    print(summary('order', order_ms))
+    print(f"{3 * n} calls over {len(standin.connections)} connection(s)")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: " + sys.argv[0] + " <alpaca account from config.ini> [n]")
+        exit()
+    n = int(sys.argv[2]) if len(sys.argv) >= 3 else 200
+    # keep the stand-in's orders out of the real event log
+    get_event_log().configure(path='alpaca-standin-events.log')
+    asyncio.get_event_loop().run_until_complete(bench(sys.argv[1], n))
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import asyncio
 import datetime
 import re
 import sys
@@ -7,8 +8,7 @@ import configparser
 from dateutil.parser import parse as parse_date
 
 from broker_root import broker_root
-from broker_ibkr import broker_ibkr
-from broker_alpaca import broker_alpaca
+from brokers import make_driver
 
 config = configparser.ConfigParser()
 config.read('config.ini')
@@ -24,6 +24,7 @@ if len(sys.argv) >= 2 and sys.argv[1] == "-h":
     print("    regular=3 ")
     print("    lotto=2")
     print("    allow_fill_above_message=0.5")
+    print("  or -t to check the message parser against the example messages")
     exit()
 
 
@@ -48,6 +49,19 @@ def parse_flexible_date(date_str):
         # Handle invalid date format
         return None
 
+# pull stop-loss/target levels out of a message, e.g. "... at 7.60 with SL 4104 (RISKY)",
+# and return the message without them so the numbers aren't mistaken for a strike or fill
+def parse_levels(message):
+    stop_loss = None
+    take_profit = None
+    pattern = re.compile(r"\b(sl|stop\s*loss|stop|tp|pt|target)\s*(?:[:@]|\bat\b)?\s*\$?([0-9]*\.?[0-9]+)\b", re.IGNORECASE)
+    for m in pattern.finditer(message):
+        if m.group(1).lower() in ["tp", "pt", "target"]:
+            take_profit = float(m.group(2))
+        else:
+            stop_loss = float(m.group(2))
+    return pattern.sub("", message), stop_loss, take_profit
+
 # Example messages:
 # Light ES 4130C fill 5.75 @here
 # Took Lotto SPX 4090 Calls @here
@@ -62,17 +76,101 @@ def parse_flexible_date(date_str):
 # Taking a STAB SPX 4090C fill  4.80 pleas go light @here
 
 
-while True:
-    message = input("Enter message: ")
-    if message == "":
-        break
-    expiry = datetime.date.today() + datetime.timedelta(days=1)
-
-    # interpreted buy parameters
+# interpret a message into its buy parameters; size is which of the account's light/regular/lotto
+# contract counts to use
+def parse_message(message):
     symbol = None
     strike = None
     expected_fill = None
     put_call = None
+    expiry = datetime.date.today() + datetime.timedelta(days=1)
+    size = "regular"
+
+    words = message.split()
+    for i in range(0, len(words)):
+        word = words[i].lower()
+        if word.lower() in ["light", "regular", "lotto"]:
+            size = word.lower()
+        elif word.lower() in ["calls","call"]:
+            put_call = "C"
+        elif word.lower() in ["puts","put"]:
+            put_call = "P"
+        elif word in ["es","nq","spx","spxw","spy","qqq","msft","aapl","amd","tsla","amzn","goog","googl","fb","nvda","nflx","intc","csco","adbe","baba","bidu","pypl","ma"]:
+            symbol = word.upper()
+        elif re.match("^[0-9]+c$", word):
+            put_call = "C"
+            strike = float(word[:-1])
+        elif re.match("^[0-9]+p$",word):
+            put_call = "P"
+            strike = float(word[:-1])
+        elif re.match("^[0-9]+$",word) and strike is None:
+            strike = float(word)
+        elif re.match("^[0-9.]+$",word) and expected_fill is None:
+            expected_fill = float(word)
+        elif re.match("^\\$[0-9.]+$",word) and expected_fill is None:
+            expected_fill = float(word[1:])
+        elif re.match("^[0-9]+/[a-z][a-z]+$",word):
+            expiry = parse_flexible_date(word)
+        elif re.match("^[a-z][a-z]+/[0-9]+$",word):
+            expiry = parse_flexible_date(word)
+        #else:
+        #    print("Unknown word: " + word)
+
+    return symbol, strike, put_call, expected_fill, expiry, size
+
+# run the example messages through the parser (python3 auto-lckyali.py -t)
+def self_test():
+    examples = [
+        # message, (symbol, strike, put_call, expected_fill, size), stop_loss, take_profit
+        ("Light ES 4130C fill 5.75 @here", ("ES", 4130, "C", 5.75, "light"), None, None),
+        ("Took Lotto SPX 4090 Calls @here", ("SPX", 4090, "C", None, "lotto"), None, None),
+        ("MSFT May/5 280 puts $6.10 light 2 contract for now @here", ("MSFT", 280, "P", 6.10, "light"), None, None),
+        ("Eyeing SPX 4115 Calls not the best setup so going with a couple contracts at 7.60 with SL 4104 (RISKY) @here",
+            ("SPX", 4115, "C", 7.60, "regular"), 4104, None),
+        ("SPX 4115C fill 7.60 SL at 4104", ("SPX", 4115, "C", 7.60, "regular"), 4104, None),
+        ("SPY 408P fill 3.30 stop at 4090 target: 5.50", ("SPY", 408, "P", 3.30, "regular"), 4090, 5.50),
+        ("Risky but AAPL 165C 14/April fill .48 @here", ("AAPL", 165, "C", 0.48, "regular"), None, None),
+    ]
+    failed = 0
+    for message, expected, expected_sl, expected_tp in examples:
+        rest, stop_loss, take_profit = parse_levels(message)
+        symbol, strike, put_call, expected_fill, expiry, size = parse_message(rest)
+        got = ((symbol, strike, put_call, expected_fill, size), stop_loss, take_profit)
+        if got != (expected, expected_sl, expected_tp):
+            failed += 1
+            print(f"FAIL: {message}\n  got {got}\n  expected {(expected, expected_sl, expected_tp)}")
+    print(f"{len(examples) - failed}/{len(examples)} example messages parsed as expected")
+    return failed == 0
+
+drivers = {}
+
+def get_driver(account) -> broker_root:
+    if account not in drivers:
+        drivers[account] = make_driver('live', account)
+    return drivers[account]
+
+async def handle_message(message):
+    message, stop_loss, take_profit = parse_levels(message)
+    symbol, strike, put_call, expected_fill, expiry, size = parse_message(message)
+
+    if symbol is None:
+        print("No symbol found")
+        return
+    if strike is None:
+        print("No strike found")
+        return
+    if put_call is None:
+        print("No put_call found")
+        return
+
+    # start the contract lookup (and the quote, if the message didn't give a fill) right away, once
+    # per broker, and let it run while the accounts get sized; every account on that broker shares it
+    prefetch = {}
+    for account in accounts:
+        kind = config[account]['driver']
+        if kind not in prefetch:
+            prefetch[kind] = asyncio.ensure_future(get_driver(account).prefetch_opt(symbol, expiry, strike, put_call, quote=expected_fill is None))
+    await asyncio.sleep(0)
 
     for account in accounts:
 
@@ -100,80 +198,48 @@ while True:
         if use_options != 'yes':
             continue
 
-        contracts = regular
-
-        words = message.split()
-        for i in range(0, len(words)):
-            word = words[i].lower()
-            if word.lower() == "light":
-                contracts = light
-            elif word.lower() == "regular":
-                contracts = regular
-            elif word.lower() in ["calls","call"]:
-                put_call = "C"
-            elif word.lower() in ["puts","put"]:
-                put_call = "P"
-            elif word.lower() == "lotto":
-                contracts = lotto
-            elif word in ["es","nq","spx","spxw","spy","qqq","msft","aapl","amd","tsla","amzn","goog","googl","fb","nvda","nflx","intc","csco","adbe","baba","bidu","pypl","ma"]:
-                symbol = word.upper()
-            elif re.match("^[0-9]+c$", word):
-                put_call = "C"
-                strike = float(word[:-1])
-            elif re.match("^[0-9]+p$",word):
-                put_call = "P"
-                strike = float(word[:-1])
-            elif re.match("^[0-9]+$",word) and strike is None:
-                strike = float(word)
-            elif re.match("^[0-9.]+$",word):
-                expected_fill = float(word)
-            elif re.match("^\\$[0-9.]+$",word):
-                expected_fill = float(word[1:])
-            elif re.match("^[0-9]+/[a-z][a-z]+$",word):
-                expiry = parse_flexible_date(word)
-            elif re.match("^[a-z][a-z]+/[0-9]+$",word):
-                expiry = parse_flexible_date(word)
-            #else:
-            #    print("Unknown word: " + word)
-
-        if symbol is None:
-            print("No symbol found")
-            break
-        if strike is None:
-            print("No strike found")
-            break
-        if put_call is None:
-            print("No put_call found")
-            break
+        contracts = {"light": light, "regular": regular, "lotto": lotto}[size]
+
         print(f"ACCOUNT: {account}")
 
         if contracts == 0:
             print("No order")
             continue
 
-        driver: broker_root = None
-        if aconfig['driver'] == 'ibkr':
-            driver = broker_ibkr('live', account)
-        elif aconfig['driver'] == 'alpaca':
-            driver = broker_alpaca('live', account)
-        else:
-            raise Exception("Unknown driver: " + aconfig['driver'])
+        driver = get_driver(account)
 
-        if expected_fill is None:
-            # example: get_price_opt('SPY', datetime.date.today, 280, 'P')
-            expected_fill = driver.get_price_opt(symbol, expiry, strike, put_call)
+        fill = expected_fill
+        if fill is None:
+            try:
+                fill = await prefetch[aconfig['driver']]
+            except Exception as e:
+                print(f"No quote for {symbol} {strike}{put_call}: {e}")
+                continue
+            if fill is None:
+                print(f"No quote for {symbol} {strike}{put_call} from {aconfig['driver']}")
+                continue
 
-        max_fill = driver.x_round(expected_fill * (1 + allow_fill_pct_above_message), 10)
+        max_fill = driver.x_round(fill * (1 + allow_fill_pct_above_message), 10)
 
-        print(f"symbol={symbol} strike={strike} put_call={put_call} expiry={expiry} expected_fill={expected_fill} contracts={contracts}")
+        print(f"symbol={symbol} strike={strike} put_call={put_call} expiry={expiry} expected_fill={fill} contracts={contracts} stop_loss={stop_loss} take_profit={take_profit}")
 
-        # example: buy_opt('SPY', datetime.date.today, 280, 'P', 1, 1.35)
-        driver.buy_opt(symbol, expiry, strike, put_call, contracts, max_fill)
+        # example: buy_opt('SPY', datetime.date.today, 280, 'P', 1, 1.35, stop_loss=278)
+        try:
+            driver.buy_opt(symbol, expiry, strike, put_call, contracts, max_fill, stop_loss=stop_loss, take_profit=take_profit)
+        except Exception as e:
+            # one account's broker rejecting the order shouldn't stop the others (or the input loop)
+            print(f"ORDER FAILED for {account}: {e}")
+            driver.handle_ex(e)
 
+    # let any lookup nobody ended up needing finish quietly
+    await asyncio.gather(*prefetch.values(), return_exceptions=True)
 
-    max_fill = None
-    if expected_fill is not None:
-        max_fill = round(expected_fill * (1 + allow_fill_pct_above_message), 1)
 
+if len(sys.argv) >= 2 and sys.argv[1] == "-t":
+    sys.exit(0 if self_test() else 1)
 
-    
+while True:
+    message = input("Enter message: ")
+    if message == "":
+        break
+    asyncio.get_event_loop().run_until_complete(handle_message(message))
@@ -1,19 +1,52 @@
 import asyncio
 import datetime
+import functools
 import time
 import configparser
+from zoneinfo import ZoneInfo
+import aiohttp
+import nest_asyncio
 from alpaca.trading.client import TradingClient
 from alpaca.trading.requests import LimitOrderRequest
 from alpaca.trading.enums import OrderSide, TimeInForce
 from alpaca.data.historical import StockHistoricalDataClient
 from alpaca.data.requests import StockLatestQuoteRequest, StockBarsRequest
-from alpaca.data.timeframe import TimeFrame
+from alpaca.data.timeframe import TimeFrame, TimeFrameUnit
 from broker_root import broker_root
-import yfinance as yf
+from event_log import get_event_log
+
+nest_asyncio.apply()
 
 alpacaconn_cache = {}
+alpacarest_cache = {}
 ticker_cache = {}
 
+log = get_event_log()
+
+# Async REST client for the calls alpaca-py doesn't cover (options). There's one per API key, holding
+# one aiohttp session whose pooled keep-alive connections are reused across calls, so only the
+# first call to each Alpaca host pays for the TCP/TLS handshake.
+class alpaca_rest:
+    def __init__(self, key, secret, trading_url, data_url):
+        self.headers = {'APCA-API-KEY-ID': key, 'APCA-API-SECRET-KEY': secret}
+        self.trading_url = trading_url
+        self.data_url = data_url
+        self.session = None
+
+    async def request(self, method, url, **kwargs):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=10, keepalive_timeout=300, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=aiohttp.ClientTimeout(total=10))
+        async with self.session.request(method, url, **kwargs) as response:
+            body = await response.json(content_type=None)
+            if response.status >= 400:
+                raise Exception(f"Alpaca {method} {url} -> {response.status} {body}")
+            return body
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
 class StockStub:
     def __init__(self, symbol):
         self.symbol = symbol
@@ -38,7 +71,7 @@ class broker_alpaca(broker_root):
 
         if self.conn is None:
             try:
-                print(f"Alpaca: Trying to connect...")
+                log.info("alpaca.connect", account=self.account)
                 paper = True if self.aconfig['paper'] == 'yes' else False
                 self.conn = TradingClient(api_key=self.aconfig['key'], secret_key=self.aconfig['secret'], paper=paper)
                 self.dataconn = StockHistoricalDataClient(api_key=self.aconfig['key'], secret_key=self.aconfig['secret'])
@@ -49,7 +82,15 @@ class broker_alpaca(broker_root):
 
             # cache the connection
             alpacaconn_cache[alcachekey] = {'conn': self.conn, 'dataconn': self.dataconn, 'time': time.time()}
-            print("Alpaca: Connected")
+            log.info("alpaca.connected", account=self.account)
+
+        # the REST session lives as long as the process; trading-url/data-url can point it elsewhere (e.g. a stand-in)
+        if alcachekey not in alpacarest_cache:
+            paper = True if self.aconfig['paper'] == 'yes' else False
+            alpacarest_cache[alcachekey] = alpaca_rest(self.aconfig['key'], self.aconfig['secret'],
+                self.aconfig.get('trading-url', 'https://paper-api.alpaca.markets' if paper else 'https://api.alpaca.markets'),
+                self.aconfig.get('data-url', 'https://data.alpaca.markets'))
+        self.rest = alpacarest_cache[alcachekey]
 
     def get_stock(self, symbol):
         # normalization of the symbol, from TV to Alpaca form
@@ -90,19 +131,19 @@ class broker_alpaca(broker_root):
             latest_multisymbol_quotes = self.dataconn.get_stock_latest_quote(multisymbol_request_params)
             if symbol not in latest_multisymbol_quotes:
                 # can't find this symbol
-                print(f"Alpaca: get_price({symbol}) failed")
+                log.warning("get_price.failed", symbol=symbol)
                 return 0
             ticker = latest_multisymbol_quotes[symbol]
             ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
 
         price = ticker.ask_price
-        print(f"  get_price({symbol}) -> {price}")
+        log.info("get_price", symbol=symbol, price=price)
         return price
 
     def get_net_liquidity(self):
         # get the current Alpaca net liquidity in USD
         net_liquidity = self.conn.get_account().last_equity
-        print(f"  get_net_liquidity() -> {net_liquidity}")
+        log.info("get_net_liquidity", account=self.account, net_liquidity=net_liquidity)
         return float(net_liquidity)
 
     def get_position_size(self, symbol):
@@ -112,89 +153,168 @@ class broker_alpaca(broker_root):
             if position.symbol == symbol:
                 position_size = int(position.qty)
                 break
-        print(f"  get_position_size({symbol}) -> {position_size}")
+        log.info("get_position_size", account=self.account, symbol=symbol, size=position_size)
         return position_size
 
+    def get_positions(self, symbols):
+        held = {position.symbol: int(position.qty) for position in self.conn.get_all_positions()}
+        positions = {symbol: held.get(symbol, 0) for symbol in symbols}
+        log.info("get_positions", account=self.account, symbols=len(symbols), held=sum(1 for v in positions.values() if v != 0))
+        return positions
 
+    # alpaca-py is synchronous, so in the async order path every TradingClient call runs on a worker
+    # thread and the event loop stays free for other accounts' orders
     async def set_position_size(self, symbol, amount):
-        print(f"set_position_size({symbol},{amount}) acct {self.account}")
+        log.info("set_position_size", account=self.account, symbol=symbol, amount=amount)
 
         # get the current position size
-        position_size = self.get_position_size(symbol)
+        position_size = await asyncio.get_event_loop().run_in_executor(None, self.get_position_size, symbol)
 
         # figure out how much to buy or sell
         position_variation = round(amount - position_size, 0)
 
         # if we need to buy or sell, do it with a limit order
         if position_variation != 0:
-            price = self.get_price(symbol)
-            high_limit_price = round(price * 1.005, 2)
-            low_limit_price  = round(price * 0.995, 2)
-
-            # convert position_variation to a string with no decimal places
-            position_variation = int(position_variation)
-
-            if position_variation > 0:
-                limit_order_data = LimitOrderRequest(
-                    symbol=symbol,
-                    limit_price=high_limit_price,
-                    qty=abs(position_variation),
-                    side=OrderSide.BUY,
-                    time_in_force=TimeInForce.DAY,
-                    extended_hours = True
-                   )
-            else:
-                limit_order_data = LimitOrderRequest(
-                    symbol=symbol,
-                    limit_price=low_limit_price,
-                    qty=abs(position_variation),
-                    side=OrderSide.SELL,
-                    time_in_force=TimeInForce.DAY,
-                    extended_hours = True
-                   )
-
-            print("  placing order: ", limit_order_data)
-            trade = self.conn.submit_order(order_data=limit_order_data)
-            print("    trade: ", trade)
-
-            # wait for the order to be filled, up to 30s
-            maxloops = 30
-            print("    waiting for trade1: ", trade)
-            trade = self.conn.get_order_by_id(trade.id)
-            while trade.status in ['new','partially_filled'] and maxloops > 0:
-                await asyncio.sleep(1)
-                print("    waiting for trade2: ", trade)
-                maxloops -= 1
-                trade = self.conn.get_order_by_id(trade.id)
-
-            # throw exception on order failure
-            if trade.status not in ['filled']:
-                msg = f"ORDER FAILED: set_position_size({symbol},{amount}) acct {self.account} -> {trade.status}"
-                print(msg)
-                self.handle_ex(msg)
-
-            print("order filled")
-
-    def download_data(self, symbol, end, duration, timeframe, cachedata=False):
-        if end != "":
-            raise Exception("Can only use blank end date")
-        if timeframe != "1 day":
-            raise Exception("Can only use 1 day timeframe")
-        if 'Y' not in duration:
-            raise Exception("Can only use years in duration, in IB format like '5 Y'")
-
-        duration_years = int(duration.split(' ')[0])
-        start = datetime.datetime.now() - datetime.timedelta(days=duration_years*365)
-
-        request_params = StockBarsRequest(symbol_or_symbols=symbol, 
-            start=start.strftime("%Y-%m-%d"), 
-            timeframe = TimeFrame.Day)
+            await self.place_variation(symbol, position_variation)
+
+    # buy (positive) or sell (negative) position_variation with a limit order around price (looked up
+    # if not given) and wait for the fill
+    async def place_variation(self, symbol, position_variation, price=None):
+        loop = asyncio.get_event_loop()
+        if price is None:
+            price = await self.get_price_async(symbol)
+        high_limit_price = round(price * 1.005, 2)
+        low_limit_price  = round(price * 0.995, 2)
+
+        # convert position_variation to a string with no decimal places
+        position_variation = int(position_variation)
+
+        if position_variation > 0:
+            limit_order_data = LimitOrderRequest(
+                symbol=symbol,
+                limit_price=high_limit_price,
+                qty=abs(position_variation),
+                side=OrderSide.BUY,
+                time_in_force=TimeInForce.DAY,
+                extended_hours = True
+               )
+        else:
+            limit_order_data = LimitOrderRequest(
+                symbol=symbol,
+                limit_price=low_limit_price,
+                qty=abs(position_variation),
+                side=OrderSide.SELL,
+                time_in_force=TimeInForce.DAY,
+                extended_hours = True
+               )
+
+        log.info("place_order", account=self.account, symbol=symbol, side=str(limit_order_data.side), qty=limit_order_data.qty, limit=limit_order_data.limit_price)
+        trade = await loop.run_in_executor(None, functools.partial(self.conn.submit_order, order_data=limit_order_data))
+        log.info("order_placed", account=self.account, order_id=str(trade.id), status=str(trade.status))
+
+        # wait for the order to be filled, up to 30s
+        maxloops = 30
+        trade = await loop.run_in_executor(None, self.conn.get_order_by_id, trade.id)
+        while trade.status in ['new','partially_filled'] and maxloops > 0:
+            await asyncio.sleep(1)
+            log.debug("order_wait", order_id=str(trade.id), status=str(trade.status), filled=trade.filled_qty)
+            maxloops -= 1
+            trade = await loop.run_in_executor(None, self.conn.get_order_by_id, trade.id)
+
+        # throw exception on order failure
+        if trade.status not in ['filled']:
+            msg = f"ORDER FAILED: place_variation({symbol},{position_variation}) acct {self.account} -> {trade.status}"
+            log.error("order_failed", account=self.account, symbol=symbol, order_id=str(trade.id), status=str(trade.status))
+            self.handle_ex(msg)
+
+        log.info("order_filled", account=self.account, order_id=str(trade.id), avg_price=trade.filled_avg_price)
+
+    # OCC option symbol, e.g. SPY230414P00408000
+    def get_option_symbol(self, symbol, expiry, strike, put_call):
+        return f"{symbol}{expiry.strftime('%y%m%d')}{put_call}{int(round(strike * 1000)):08d}"
+
+    # example: get_price_opt('SPY', datetime.date.today, 280, 'P')
+    def get_price_opt(self, symbol, expiry, strike, put_call):
+        return asyncio.get_event_loop().run_until_complete(self.get_price_opt_async(symbol, expiry, strike, put_call))
+
+    async def get_price_opt_async(self, symbol, expiry, strike, put_call):
+        optsymbol = self.get_option_symbol(symbol, expiry, strike, put_call)
+        body = await self.rest.request('GET', f"{self.rest.data_url}/v1beta1/options/quotes/latest", params={'symbols': optsymbol})
+        quote = body.get('quotes', {}).get(optsymbol)
+        if quote is None or not quote.get('ap'):
+            raise Exception(f"error trying to retrieve option price for {optsymbol}, quote={quote}")
+
+        price = quote['ap']
+        log.info("get_price_opt", symbol=optsymbol, price=price)
+        return price
+
+    # example: buy_opt('SPY', datetime.date.today, 280, 'P', 1, 1.35, stop_loss=1.00, take_profit=2.50)
+    def buy_opt(self, symbol, expiry, strike, put_call, amount, max_price, stop_loss=None, take_profit=None):
+        asyncio.get_event_loop().run_until_complete(
+            self.buy_opt_async(symbol, expiry, strike, put_call, amount, max_price, stop_loss=stop_loss, take_profit=take_profit))
+
+    async def buy_opt_async(self, symbol, expiry, strike, put_call, amount, max_price, stop_loss=None, take_profit=None):
+        log.info("buy_opt", account=self.account, symbol=symbol, expiry=str(expiry), strike=strike, put_call=put_call, amount=amount, max_price=max_price, stop_loss=stop_loss, take_profit=take_profit)
+        optsymbol = self.get_option_symbol(symbol, expiry, strike, put_call)
+
+        # Alpaca only takes simple orders for options, so there's no way to attach exits to the entry;
+        # a bracket/OTO entry would just be rejected. Send the entry alone and say what got dropped.
+        if stop_loss is not None:
+            log.warning("buy_opt.stop_dropped", symbol=optsymbol, stop_loss=stop_loss)
+        if take_profit is not None:
+            log.warning("buy_opt.target_dropped", symbol=optsymbol, take_profit=take_profit)
+
+        order = {'symbol': optsymbol, 'qty': str(amount), 'side': 'buy', 'type': 'limit',
+                 'limit_price': str(max_price), 'time_in_force': 'day', 'order_class': 'simple'}
+
+        log.info("place_order", account=self.account, symbol=optsymbol, qty=amount, limit=max_price, order_class=order['order_class'])
+        trade = await self.rest.request('POST', f"{self.rest.trading_url}/v2/orders", json=order)
+        log.info("order_placed", account=self.account, order_id=trade['id'], status=trade['status'])
+
+        # wait for the order to be filled, up to 30s
+        maxloops = 30
+        trade = await self.rest.request('GET', f"{self.rest.trading_url}/v2/orders/{trade['id']}")
+        while trade['status'] in ['new','accepted','pending_new','partially_filled'] and maxloops > 0:
+            await asyncio.sleep(1)
+            log.debug("order_wait", order_id=trade['id'], status=trade['status'], filled=trade.get('filled_qty'))
+            maxloops -= 1
+            trade = await self.rest.request('GET', f"{self.rest.trading_url}/v2/orders/{trade['id']}")
+
+        # throw exception on order failure
+        if trade['status'] not in ['filled']:
+            msg = f"ORDER FAILED: buy_opt({optsymbol},{amount},{max_price}) acct {self.account} -> {trade['status']}"
+            log.error("order_failed", account=self.account, symbol=optsymbol, order_id=trade['id'], status=trade['status'])
+            self.handle_ex(msg)
+
+        log.info("order_filled", account=self.account, order_id=trade['id'], avg_price=trade.get('filled_avg_price'))
+
+    # example: download_data('SOXL', '', '1 Y', '1 hour'), with IB-style end/duration/bar size strings
+    def download_data(self, symbol, end, duration, timeframe, cachedata=False, trim=True):
+        log.info("download_data", symbol=symbol, end=end, duration=duration, barlength=timeframe)
+        stock = self.get_stock(symbol)
+
+        n, unit = timeframe.split(' ')
+        units = {'min': TimeFrameUnit.Minute, 'hour': TimeFrameUnit.Hour, 'day': TimeFrameUnit.Day,
+                 'week': TimeFrameUnit.Week, 'month': TimeFrameUnit.Month}
+        if unit.rstrip('s') not in units:
+            raise Exception(f"Unsupported Alpaca bar size: {timeframe}")
+
+        # IB-style times are exchange time; Alpaca reads naive datetimes as UTC
+        eastern = ZoneInfo('America/New_York')
+        end_time = self.parse_ib_end(end)
+        if end_time is not None:
+            end_time = end_time.replace(tzinfo=eastern)
+        start = (end_time or datetime.datetime.now(eastern)) - self.parse_ib_duration(duration)
+
+        request_params = StockBarsRequest(symbol_or_symbols=symbol,
+            start=start,
+            end=end_time,
+            timeframe = TimeFrame(int(n), units[unit.rstrip('s')]))
 
         bars = self.dataconn.get_stock_bars(request_params)
-        return bars.df
+        df = self.normalize_bars(bars.df.xs(symbol, level='symbol'), timeframe)
+        if trim:
+            df = self.trim_partial_bar(df, stock, timeframe)
 
-    def health_check(self):
-        self.get_net_liquidity()
-        self.get_price('SOXL')
-        self.get_position_size('SOXL')
-        self.get_position_size('SOXS')
+        log.info("download_data.done", symbol=symbol, barlength=timeframe, bars=len(df))
+        return df
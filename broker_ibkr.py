@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import functools
 import os
 from ib_insync import *
 import time
@@ -9,12 +10,17 @@ import math
 
 import pandas as pd
 from broker_root import broker_root
+from event_log import get_event_log
 
 nest_asyncio.apply()
 
 ibconn_cache = {}
 stock_cache = {}
 ticker_cache = {}
+option_cache = {}
+ibconn_pending = {}
+
+log = get_event_log()
 
 # declare a class to represent the IB driver
 class broker_ibkr(broker_root):
@@ -35,7 +41,7 @@ class broker_ibkr(broker_root):
         if self.conn is None:
             self.conn = IB()
             try:
-                print(f"IB: Trying to connect...")
+                log.info("ib.connect", host=self.aconfig['host'], port=self.aconfig['port'])
                 self.conn.connect(self.aconfig['host'], self.aconfig['port'], clientId=1)
             except Exception as e:
                 try:
@@ -52,7 +58,41 @@ class broker_ibkr(broker_root):
 
             # cache the connection
             ibconn_cache[ibcachekey] = {'conn': self.conn, 'time': time.time()}
-            print("IB: Connected")
+            log.info("ib.connected", host=self.aconfig['host'], port=self.aconfig['port'])
+
+    # same as load_conn, but connects with connectAsync so several gateways can be connected at
+    # once; accounts on the same host:port wait for the one connection instead of opening their own
+    async def load_conn_async(self):
+        ibcachekey = f"{self.aconfig['host']}:{self.aconfig['port']}"
+        if ibcachekey in ibconn_cache:
+            self.conn = ibconn_cache[ibcachekey]['conn']
+            return
+
+        if ibcachekey not in ibconn_pending:
+            ibconn_pending[ibcachekey] = asyncio.ensure_future(self.connect_async(ibcachekey))
+        try:
+            self.conn = await asyncio.shield(ibconn_pending[ibcachekey])
+        finally:
+            if ibconn_pending.get(ibcachekey) is not None and ibconn_pending[ibcachekey].done():
+                del ibconn_pending[ibcachekey]
+
+    async def connect_async(self, ibcachekey):
+        conn = IB()
+        log.info("ib.connect", host=self.aconfig['host'], port=self.aconfig['port'])
+        for client_id in [1, 3, 4, 5]:
+            try:
+                await conn.connectAsync(self.aconfig['host'], self.aconfig['port'], clientId=client_id)
+                break
+            except Exception as e:
+                error = e
+        else:
+            self.handle_ex(error)
+            raise error
+
+        # cache the connection
+        ibconn_cache[ibcachekey] = {'conn': conn, 'time': time.time()}
+        log.info("ib.connected", host=self.aconfig['host'], port=self.aconfig['port'])
+        return conn
 
     def get_stock(self, symbol, forhistory=False):
         self.load_conn()
@@ -169,6 +209,12 @@ class broker_ibkr(broker_root):
                 stock.round_precision = 100
                 stock.market_order = False
 
+            elif symbol in ['SPX', 'SPXW']:
+                stock = Index('SPX', 'CBOE')
+                stock.is_futures = 0
+                stock.round_precision = 100
+                stock.market_order = False
+
             elif symbol == 'VIX':
                 stock = Index(symbol, 'CBOE')
                 stock.is_futures = 0
@@ -213,45 +259,89 @@ class broker_ibkr(broker_root):
             [ticker] = self.conn.reqTickers(stock)
             ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
 
+        price = self.ticker_price(symbol, ticker)
+        log.info("get_price", symbol=symbol, price=price)
+        return price
+
+    async def get_price_async(self, symbol):
+        self.load_conn()
+        stock = self.get_stock(symbol)
+
+        if symbol in ticker_cache and time.time() - ticker_cache[symbol]['time'] < 5:
+            ticker = ticker_cache[symbol]['ticker']
+        else:
+            [ticker] = await self.conn.reqTickersAsync(stock)
+            ticker_cache[symbol] = {'ticker': ticker, 'time': time.time()}
+
+        price = self.ticker_price(symbol, ticker)
+        log.info("get_price", symbol=symbol, price=price)
+        return price
+
+    def ticker_price(self, symbol, ticker):
         if math.isnan(ticker.last):
             if math.isnan(ticker.close):
                 raise Exception(f"error trying to retrieve stock price for {symbol}, last={ticker.last}, close={ticker.close}")
             else:
-                price = ticker.close
-        else:
-            price = ticker.last
-        print(f"  get_price({symbol}) -> {price}")
-        return price
+                return ticker.close
+        return ticker.last
+
+    # the option contract used for both quotes and orders; once qualified it's cached, so a signal
+    # only looks its contract up once however many accounts trade it
+    def get_option_contract(self, symbol, expiry, strike, put_call):
+        datestr = expiry.strftime("%Y%m%d")
+        key = (symbol, datestr, strike, put_call)
+        if key in option_cache:
+            return option_cache[key]
+        return Option(symbol, datestr, strike, put_call, exchange="CBOE", currency="USD")
+
+    async def get_option_contract_async(self, symbol, expiry, strike, put_call):
+        self.load_conn()
+        contract = self.get_option_contract(symbol, expiry, strike, put_call)
+        if not contract.conId:
+            await self.conn.qualifyContractsAsync(contract)
+            option_cache[(symbol, expiry.strftime("%Y%m%d"), strike, put_call)] = contract
+        return contract
 
     # example: get_price_opt('SPY', datetime.date.today, 280, 'P')
     def get_price_opt(self, symbol, expiry, strike, put_call):
         self.load_conn()
-
-        datestr = expiry.strftime("%Y%m%d")
-        contract = Option(symbol, datestr, strike, put_call, exchange="SMART", currency="USD", tradingClass='SPX')
+        contract = self.get_option_contract(symbol, expiry, strike, put_call)
         [ticker] = self.conn.reqTickers(contract)
 
-        if math.isnan(ticker.last):
-            if math.isnan(ticker.close):
-                raise Exception("error trying to retrieve stock price for " + symbol)
-            else:
-                price = ticker.close
-        else:
-            price = ticker.last
-        print(f"  get_price({symbol}) -> {price}")
+        price = self.ticker_price(symbol, ticker)
+        log.info("get_price_opt", symbol=symbol, expiry=str(expiry), strike=strike, put_call=put_call, price=price)
         return price
 
+    async def get_price_opt_async(self, symbol, expiry, strike, put_call):
+        contract = await self.get_option_contract_async(symbol, expiry, strike, put_call)
+        [ticker] = await self.conn.reqTickersAsync(contract)
+
+        price = self.ticker_price(symbol, ticker)
+        log.info("get_price_opt", symbol=symbol, expiry=str(expiry), strike=strike, put_call=put_call, price=price)
+        return price
+
+    async def prefetch_opt(self, symbol, expiry, strike, put_call, quote=True):
+        if quote:
+            return await self.get_price_opt_async(symbol, expiry, strike, put_call)
+        await self.get_option_contract_async(symbol, expiry, strike, put_call)
+
     def get_net_liquidity(self):
         self.load_conn()
+        return self.net_liquidity_from_summary(self.conn.accountSummary(self.account))
+
+    async def get_net_liquidity_async(self):
+        self.load_conn()
+        return self.net_liquidity_from_summary(await self.conn.accountSummaryAsync(self.account))
+
+    def net_liquidity_from_summary(self, accountSummary):
         # get the current net liquidity
         net_liquidity = 0
-        accountSummary = self.conn.accountSummary(self.account)
         for value in accountSummary:
             if value.tag == 'NetLiquidation':
                 net_liquidity = float(value.value)
                 break
 
-        print(f"  get_net_liquidity() -> {net_liquidity}")
+        log.info("get_net_liquidity", account=self.account, net_liquidity=net_liquidity)
 
         return net_liquidity
 
@@ -264,13 +354,23 @@ class broker_ibkr(broker_root):
             if p.contract.symbol == stock.symbol:
                 psize = int(p.position)
 
-        print(f"  get_position_size({symbol}) -> {psize}")
+        log.info("get_position_size", account=self.account, symbol=symbol, size=psize)
         return psize
 
+    def get_positions(self, symbols):
+        self.load_conn()
+        held = {p.contract.symbol: int(p.position) for p in self.conn.positions(self.account)}
+        positions = {symbol: held.get(self.get_stock(symbol).symbol, 0) for symbol in symbols}
+        log.info("get_positions", account=self.account, symbols=len(symbols), held=sum(1 for v in positions.values() if v != 0))
+        return positions
+
+    # ib_insync keeps positions up to date locally, so this needs no request (and no worker thread)
+    async def get_positions_async(self, symbols):
+        return self.get_positions(symbols)
+
     async def set_position_size(self, symbol, amount):
-        print(f"set_position_size({self.account},{symbol},{amount})")
+        log.info("set_position_size", account=self.account, symbol=symbol, amount=amount)
         self.load_conn()
-        stock = self.get_stock(symbol)
 
         # get the current position size
         position_size = self.get_position_size(symbol)
@@ -280,72 +380,96 @@ class broker_ibkr(broker_root):
 
         # if we need to buy or sell, do it with a limit order
         if position_variation != 0:
+            await self.place_variation(symbol, position_variation)
 
-            if stock.market_order:
-                if position_variation > 0:
-                    order = MarketOrder('BUY', position_variation)
-                else:
-                    order = MarketOrder('SELL', abs(position_variation))
+    # buy (positive) or sell (negative) position_variation with a limit order around price (looked up
+    # if not given) and wait for the fill
+    async def place_variation(self, symbol, position_variation, price=None):
+        self.load_conn()
+        stock = self.get_stock(symbol)
 
+        if stock.market_order:
+            if position_variation > 0:
+                order = MarketOrder('BUY', position_variation)
             else:
-                price = self.get_price(symbol)
-                high_limit_price = self.x_round(price * 1.005, stock.round_precision)
-                low_limit_price  = self.x_round(price * 0.995, stock.round_precision)
+                order = MarketOrder('SELL', abs(position_variation))
 
-                if position_variation > 0:
-                    order = LimitOrder('BUY', position_variation, high_limit_price)
-                else:
-                    order = LimitOrder('SELL', abs(position_variation), low_limit_price)
+        else:
+            if price is None:
+                price = self.get_price(symbol)
+            high_limit_price = self.x_round(price * 1.005, stock.round_precision)
+            low_limit_price  = self.x_round(price * 0.995, stock.round_precision)
 
-            order.outsideRth = True
-            order.account = self.account
+            if position_variation > 0:
+                order = LimitOrder('BUY', position_variation, high_limit_price)
+            else:
+                order = LimitOrder('SELL', abs(position_variation), low_limit_price)
 
-            print("  placing order: ", order)
-            trade = self.conn.placeOrder(stock, order)
-            print("    trade: ", trade)
+        order.outsideRth = True
+        order.account = self.account
 
-            # wait for the order to be filled, up to 30s
-            maxloops = 15
-            print("    waiting for trade1: ", trade)
-            while trade.orderStatus.status not in ['Filled','Cancelled','ApiCancelled'] and maxloops > 0:
-                #self.conn.sleep(1)
-                await asyncio.sleep(1)
-                print("    waiting for trade2: ", trade)
-                maxloops -= 1
+        log.info("place_order", account=self.account, symbol=symbol, action=order.action, qty=order.totalQuantity, type=order.orderType, limit=order.lmtPrice)
+        trade = self.conn.placeOrder(stock, order)
+        log.info("order_placed", account=self.account, order_id=trade.order.orderId, status=trade.orderStatus.status)
 
+        # wait for the order to be filled, up to 30s
+        maxloops = 15
+        while trade.orderStatus.status not in ['Filled','Cancelled','ApiCancelled'] and maxloops > 0:
+            #self.conn.sleep(1)
             await asyncio.sleep(1)
+            log.debug("order_wait", order_id=trade.order.orderId, status=trade.orderStatus.status, filled=trade.orderStatus.filled)
+            maxloops -= 1
 
-            # throw exception on order failure
-            if trade.orderStatus.status not in ['Filled']:
-                msg = f"ORDER FAILED in status {trade.orderStatus.status}: set_position_size({self.account},{symbol},{stock},{amount},{stock.round_precision}) -> {trade.orderStatus}"
-                print(msg)
-                self.handle_ex(msg)
+        await asyncio.sleep(1)
 
-            print("order filled")
+        # throw exception on order failure
+        if trade.orderStatus.status not in ['Filled']:
+            msg = f"ORDER FAILED in status {trade.orderStatus.status}: place_variation({self.account},{symbol},{stock},{position_variation},{stock.round_precision}) -> {trade.orderStatus}"
+            log.error("order_failed", account=self.account, symbol=symbol, order_id=trade.order.orderId, status=trade.orderStatus.status)
+            self.handle_ex(msg)
 
-    # example: buy_opt('SPY', datetime.date.today, 280, 'P', 1, 1.35)
-    def buy_opt(self, symbol, expiry, strike, put_call, amount, max_price):
-        print(f"buy_opt({self.account},{symbol},{expiry},{strike},{put_call},{amount}, {max_price})")
+        log.info("order_filled", account=self.account, order_id=trade.order.orderId, avg_price=trade.orderStatus.avgFillPrice)
+
+    # example: buy_opt('SPY', datetime.date.today, 280, 'P', 1, 1.35, stop_loss=278, take_profit=2.50)
+    def buy_opt(self, symbol, expiry, strike, put_call, amount, max_price, stop_loss=None, take_profit=None):
+        log.info("buy_opt", account=self.account, symbol=symbol, expiry=str(expiry), strike=strike, put_call=put_call, amount=amount, max_price=max_price, stop_loss=stop_loss, take_profit=take_profit)
         self.load_conn()
 
-        datestr = expiry.strftime("%Y%m%d")
-        contract = Option(symbol, datestr, strike, put_call, exchange="CBOE", currency="USD")
+        contract = self.get_option_contract(symbol, expiry, strike, put_call)
 
         order = LimitOrder('BUY', amount, max_price)
 
         order.outsideRth = True
         order.account = self.account
 
-        print("  placing order: ", order)
+        # attach the stop/target as children of the entry, so IB gets the whole bracket in one
+        # transmission and the position is never live without its protection
+        children = self.bracket_children_opt(symbol, strike, put_call, amount, max_price, stop_loss, take_profit)
+        if children:
+            order.orderId = self.conn.client.getReqId()
+            order.transmit = False
+            for child in children:
+                child.orderId = self.conn.client.getReqId()
+                child.parentId = order.orderId
+                child.ocaGroup = f"bracket-{order.orderId}"
+                child.ocaType = 1
+                child.outsideRth = True
+                child.account = self.account
+                child.transmit = False
+            children[-1].transmit = True
+
+        log.info("place_order", account=self.account, symbol=symbol, action=order.action, qty=order.totalQuantity, type=order.orderType, limit=order.lmtPrice)
         trade = self.conn.placeOrder(contract, order)
-        print("    trade: ", trade)
+        for child in children:
+            log.info("place_child_order", account=self.account, parent_id=order.orderId, action=child.action, type=child.orderType, aux=child.auxPrice, limit=child.lmtPrice, conditional=bool(child.conditions))
+            self.conn.placeOrder(contract, child)
+        log.info("order_placed", account=self.account, order_id=trade.order.orderId, status=trade.orderStatus.status)
 
         # wait for the order to be filled, up to 30s
         maxloops = 15
-        print("    waiting for trade1: ", trade)
         while trade.orderStatus.status not in ['Filled','Cancelled','ApiCancelled'] and maxloops > 0:
             self.conn.sleep(1)
-            print("    waiting for trade2: ", trade)
+            log.debug("order_wait", order_id=trade.order.orderId, status=trade.orderStatus.status, filled=trade.orderStatus.filled)
             maxloops -= 1
 
         self.conn.sleep(1)
@@ -353,20 +477,58 @@ class broker_ibkr(broker_root):
         # throw exception on order failure
         if trade.orderStatus.status not in ['Filled']:
             msg = f"ORDER FAILED in status {trade.orderStatus.status}: buy_opt({self.account},{symbol},{expiry},{strike},{put_call},{amount}, {max_price}) -> {trade.orderStatus}"
-            print(msg)
+            log.error("order_failed", account=self.account, symbol=symbol, order_id=trade.order.orderId, status=trade.orderStatus.status)
             self.handle_ex(msg)
 
-        print("order filled")
+        log.info("order_filled", account=self.account, order_id=trade.order.orderId, avg_price=trade.orderStatus.avgFillPrice)
+
+    # build the exit orders for a long option position: levels near the strike are on the
+    # underlying and become price-conditioned market orders, the rest are plain stop/limit
+    # orders on the option premium. A level that can't be placed (a premium stop at or above the
+    # entry, a premium target at or below it, an underlying that won't qualify) is dropped with a
+    # warning rather than sent, since a rejected child takes the untransmitted entry down with it
+    def bracket_children_opt(self, symbol, strike, put_call, amount, max_price, stop_loss, take_profit):
+        children = []
+        underlying = None
+        for level, is_stop in [(stop_loss, True), (take_profit, False)]:
+            if level is None:
+                continue
+            if self.is_underlying_level(strike, level):
+                if underlying is None:
+                    underlying = self.get_stock(symbol)
+                    if not underlying.conId:
+                        self.conn.qualifyContracts(underlying)
+                if not underlying.conId:
+                    log.warning("bracket.unqualified_underlying", account=self.account, symbol=symbol, level=level, stop=is_stop)
+                    continue
+                # calls stop out when the underlying falls and take profit when it rises, puts the other way round
+                ismore = (put_call == 'P') == is_stop
+                child = MarketOrder('SELL', amount)
+                child.conditions = [PriceCondition(isMore=ismore, price=level, conId=underlying.conId, exch=underlying.exchange)]
+                child.conditionsIgnoreRth = True
+            elif is_stop:
+                if level >= max_price:
+                    log.warning("bracket.stop_dropped", account=self.account, symbol=symbol, stop_loss=level, max_price=max_price)
+                    continue
+                child = StopOrder('SELL', amount, level)
+            else:
+                if level <= max_price:
+                    log.warning("bracket.target_dropped", account=self.account, symbol=symbol, take_profit=level, max_price=max_price)
+                    continue
+                child = LimitOrder('SELL', amount, level)
+            children.append(child)
+        return children
 
 
-    def download_data(self, symbol, end, duration, barlength, cachedata=False):
-        print(f"download_data({symbol},{end},{duration},{barlength})")
+    # trim=False keeps a partial last bar, for callers that build other bar sizes from these and trim those instead
+    def download_data(self, symbol, end, duration, barlength, cachedata=False, trim=True):
+        log.info("download_data", symbol=symbol, end=end, duration=duration, barlength=barlength)
 
-        cachefile = f"cache/stockdata-{symbol}-{end.replace(' ','_')}-{duration.replace(' ','_')}-{barlength}.pkl"
+        cachefile = f"cache/stockdata-{symbol}-{end.replace(' ','_')}-{duration.replace(' ','_')}-{barlength}{'' if trim else '-untrimmed'}.pkl"
 
         # check if we have a cached version of the data and it's not more than 1h old
         if cachedata and os.path.exists(cachefile) and time.time() - os.path.getmtime(cachefile) < 3600:
-            print("  loading cached data")
+            log.info("download_data.cached", symbol=symbol, cachefile=cachefile)
             df = pd.read_pickle(cachefile)
             return df
 
@@ -374,57 +536,28 @@ class broker_ibkr(broker_root):
         stock = self.get_stock(symbol, forhistory=True)
 
         # request historical bars
-        useRTH = False
-        if 'day' in barlength or 'week' in barlength or 'month' in barlength:
-            useRTH = True
-
         bars = self.conn.reqHistoricalData(
             stock,
             endDateTime=end,
             durationStr=duration,
             barSizeSetting=barlength,
             whatToShow='TRADES',
-            useRTH=useRTH,
+            useRTH=self.history_use_rth(barlength),
             formatDate=1,
             timeout = 300
         )
-        # convert to df, and rename columns from 'open' to 'Open' etc to make it look like Yahoo data
-        df = util.df(bars,labels=['date','open','high','low','close','volume'])
-        df.columns = [c.capitalize() for c in df.columns]
-        # make the date column the index
-        df.set_index('Date', inplace=True)
-        # convert date to pandas timestamp
-        df.index = pd.to_datetime(df.index)
+        df = self.bars_to_df(bars)
 
         # clear out last line if it's a partial bar
         # (IB gives us partial bars and doesn't identify them as such)
-        if not stock.is_futures:
-            nowisinRTH = datetime.datetime.now().time() >= datetime.time(9,30,0) and \
-                datetime.datetime.now().time() < datetime.time(16,0,0)
-            nowisinETH = datetime.datetime.now().time() >= datetime.time(4,0,0) and \
-                datetime.datetime.now().time() < datetime.time(20,0,0)
-            if 'day' in barlength:
-                if nowisinRTH:
-                    df = df[:-1]
-            elif 'week' in barlength:
-                pass
-            elif 'month' in barlength:
-                pass
-            elif 'hour' in barlength:
-                if not nowisinETH:
-                    df = df[:-1]
-            elif 'min' in barlength:
-                if not nowisinETH:
-                    df = df[:-1]
-        else:
-            # assume futures are always active (so the last record is always a partial bar)
-            df = df[:-1]
+        if trim:
+            df = self.trim_partial_bar(df, stock, barlength)
 
         # special case: NDX doesn't give us volume, so we have to pick it up from QQQ
         if (symbol == 'NDX'):
-            df['Volume'] = self.download_data('QQQ', end, duration, barlength)['Volume']
+            df['Volume'] = self.download_data('QQQ', end, duration, barlength, trim=trim)['Volume']
 
-        print(f"  download_data({symbol},{end},{duration},{barlength}) -> {len(bars)} bars")
+        log.info("download_data.done", symbol=symbol, barlength=barlength, bars=len(bars))
 
         if cachedata:
             # cache the data
@@ -433,8 +566,54 @@ class broker_ibkr(broker_root):
         return df
 
 
-    def health_check(self):
-        self.get_net_liquidity()
-        self.get_price('SOXL')
-        self.get_position_size('SOXL')
-        self.get_position_size('SOXS')
+    # same as download_data (without the file cache), but awaitable so it can race other data sources
+    async def download_data_async(self, symbol, end, duration, barlength):
+        log.info("download_data_async", symbol=symbol, end=end, duration=duration, barlength=barlength)
+        self.load_conn()
+        stock = self.get_stock(symbol, forhistory=True)
+
+        bars = await self.conn.reqHistoricalDataAsync(
+            stock,
+            endDateTime=end,
+            durationStr=duration,
+            barSizeSetting=barlength,
+            whatToShow='TRADES',
+            useRTH=self.history_use_rth(barlength),
+            formatDate=1,
+            timeout = 300
+        )
+        df = self.trim_partial_bar(self.bars_to_df(bars), stock, barlength)
+
+        # special case: NDX doesn't give us volume, so we have to pick it up from QQQ
+        if (symbol == 'NDX'):
+            df['Volume'] = (await self.download_data_async('QQQ', end, duration, barlength))['Volume']
+
+        log.info("download_data_async.done", symbol=symbol, barlength=barlength, bars=len(bars))
+        return df
+
+    def history_use_rth(self, barlength):
+        return 'day' in barlength or 'week' in barlength or 'month' in barlength
+
+    def bars_to_df(self, bars):
+        # convert to df, and rename columns from 'open' to 'Open' etc to make it look like Yahoo data
+        df = util.df(bars,labels=['date','open','high','low','close','volume'])
+        df.columns = [c.capitalize() for c in df.columns]
+        # make the date column the index
+        df.set_index('Date', inplace=True)
+        # convert date to pandas timestamp
+        df.index = pd.to_datetime(df.index)
+        return df
+
+    # IB calls have to stay on the event loop (ib_insync isn't thread-safe), so the probes are
+    # coroutines; positions come from ib_insync's local state and need no request
+    def health_probes(self, symbols):
+        self.load_conn()
+
+        async def position(symbol):
+            return self.get_position_size(symbol)
+
+        probes = [('net_liquidity', self.get_net_liquidity_async)]
+        for symbol in symbols:
+            probes.append((f"price {symbol}", functools.partial(self.get_price_async, symbol)))
+            probes.append((f"position {symbol}", functools.partial(position, symbol)))
+        return probes
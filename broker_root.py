@@ -1,4 +1,7 @@
 
+import asyncio
+import datetime
+import functools
 from unittest import skip
 from textmagic.rest import TextmagicRestClient
 import traceback
@@ -29,17 +32,125 @@ class broker_root:
     def get_price(self, symbol):
         pass
 
+    def get_price_opt(self, symbol, expiry, strike, put_call):
+        pass
+
+    async def get_price_opt_async(self, symbol, expiry, strike, put_call):
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_price_opt, symbol, expiry, strike, put_call)
+
+    # warm up whatever the driver needs to trade this option (contract lookup, and the quote if
+    # quote is set) as soon as a signal is parsed; returns the quote, or None
+    async def prefetch_opt(self, symbol, expiry, strike, put_call, quote=True):
+        if quote:
+            return await self.get_price_opt_async(symbol, expiry, strike, put_call)
+
+    # a stop/target level close to the strike is a level on the underlying (e.g. "SL 4104" on a
+    # SPX 4115C), anything else is a price on the option premium itself (e.g. "SL 3.50")
+    def is_underlying_level(self, strike, level):
+        return abs(level - strike) / strike < 0.25
+
     def get_net_liquidity(self):
         pass
 
     def get_position_size(self, symbol):
         pass
 
+    # current position sizes for several symbols from a single positions lookup
+    def get_positions(self, symbols):
+        pass
+
+    # awaitable versions of the account/quote lookups: by default the blocking call runs on a worker
+    # thread, drivers with a native async API override them
+    async def get_price_async(self, symbol):
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_price, symbol)
+
+    async def get_net_liquidity_async(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_net_liquidity)
+
+    async def get_positions_async(self, symbols):
+        return await asyncio.get_event_loop().run_in_executor(None, self.get_positions, symbols)
+
     async def set_position_size(self, symbol, amount):
         pass
 
-    def download_data(self, symbol, end, duration, timeframe):
+    async def place_variation(self, symbol, position_variation, price=None):
+        pass
+
+    def buy_opt(self, symbol, expiry, strike, put_call, amount, max_price, stop_loss=None, take_profit=None):
+        pass
+
+    def download_data(self, symbol, end, duration, timeframe, cachedata=False, trim=True):
         pass
 
+    # drop the last bar of a download if it's still being built; also used for bars we
+    # resample locally, so both paths agree on what counts as a complete bar
+    def trim_partial_bar(self, df, stock, barlength):
+        if not stock.is_futures:
+            nowisinRTH = datetime.datetime.now().time() >= datetime.time(9,30,0) and \
+                datetime.datetime.now().time() < datetime.time(16,0,0)
+            nowisinETH = datetime.datetime.now().time() >= datetime.time(4,0,0) and \
+                datetime.datetime.now().time() < datetime.time(20,0,0)
+            if 'day' in barlength:
+                if nowisinRTH:
+                    df = df[:-1]
+            elif 'week' in barlength:
+                pass
+            elif 'month' in barlength:
+                pass
+            elif 'hour' in barlength:
+                if not nowisinETH:
+                    df = df[:-1]
+            elif 'min' in barlength:
+                if not nowisinETH:
+                    df = df[:-1]
+        else:
+            # assume futures are always active (so the last record is always a partial bar)
+            df = df[:-1]
+        return df
+
+    # IB duration strings like '30 D' or '5 Y' as a timedelta
+    def parse_ib_duration(self, duration):
+        n, unit = duration.split(' ')
+        days = {'S': 1/86400, 'D': 1, 'W': 7, 'M': 31, 'Y': 365}[unit]
+        return datetime.timedelta(days=int(n) * days)
+
+    # IB end strings: '' means now, otherwise 'YYYYMMDD HH:MM:SS' or 'YYYYMMDD-HH:MM:SS'
+    def parse_ib_end(self, end):
+        if end == '':
+            return None
+        return datetime.datetime.strptime(end[:17].replace('-', ' '), '%Y%m%d %H:%M:%S')
+
+    # bring bars from any data source into the IB-style frame: Open/High/Low/Close/Volume columns
+    # and a tz-naive exchange-time index (midnight for day/week/month bars)
+    def normalize_bars(self, df, barlength):
+        df = df.rename(columns=lambda c: c.capitalize())[['Open', 'High', 'Low', 'Close', 'Volume']]
+        if df.index.tz is not None:
+            df.index = df.index.tz_convert('America/New_York').tz_localize(None)
+        if 'day' in barlength or 'week' in barlength or 'month' in barlength:
+            df.index = df.index.normalize()
+        df.index.name = 'Date'
+        return df.sort_index()
+
+    # open the broker connection without blocking the event loop; drivers that connect in
+    # __init__ have nothing left to do
+    async def load_conn_async(self):
+        pass
+
+    # instruments to probe in health checks, from the account's health-check-symbols setting
+    def health_check_symbols(self):
+        return [s.strip() for s in self.aconfig.get('health-check-symbols', 'SOXL,SOXS').split(',')]
+
+    # the calls a health check makes, as (name, callable) pairs; plain callables are run on a worker
+    # thread by the health-check runner, coroutine functions on its event loop
+    def health_probes(self, symbols):
+        probes = [('net_liquidity', self.get_net_liquidity)]
+        for symbol in symbols:
+            probes.append((f"price {symbol}", functools.partial(self.get_price, symbol)))
+            probes.append((f"position {symbol}", functools.partial(self.get_position_size, symbol)))
+        return probes
+
     def health_check(self):
-        pass
\ No newline at end of file
+        self.get_net_liquidity()
+        for symbol in self.health_check_symbols():
+            self.get_price(symbol)
+            self.get_position_size(symbol)
@@ -0,0 +1,24 @@
+import configparser
+
+from broker_root import broker_root
+from broker_ibkr import broker_ibkr
+from broker_alpaca import broker_alpaca
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# build the driver an account is configured for (its 'driver' setting)
+def make_driver(bot, account) -> broker_root:
+    aconfig = config[account]
+    if aconfig['driver'] == 'ibkr':
+        return broker_ibkr(bot, account)
+    elif aconfig['driver'] == 'alpaca':
+        return broker_alpaca(bot, account)
+    else:
+        raise Exception("Unknown driver: " + aconfig['driver'])
+
+# the accounts for a bot, from its [bot-<name>] accounts-<name> list; with no bot, every account with a driver
+def bot_accounts(bot=None):
+    if bot is None:
+        return [s for s in config.sections() if 'driver' in config[s]]
+    return [a.strip() for a in config[f"bot-{bot}"][f"accounts-{bot}"].split(",")]
@@ -0,0 +1,218 @@
+#
+# Check hedged_fetch offline against fake sources:
+#
+#   python3 data_sources.py -t
+
+import asyncio
+import datetime
+import sys
+import time
+
+import pandas as pd
+import yfinance as yf
+from event_log import get_event_log
+
+log = get_event_log()
+
+# Historical bar providers. Each one takes IB-style arguments (end, duration, bar size) and
+# returns the same Open/High/Low/Close/Volume frame broker_ibkr.download_data does, so
+# hedged_fetch can race them and use whichever answers first. Symbols come in TradingView/IB
+# form; a provider translates them into its own tickers in provider_symbol and raises for any
+# it can't serve, rather than answering with some other instrument's bars.
+
+# cash indices, which neither trade nor have bars on Alpaca
+index_symbols = {'SPX': '^GSPC', 'SPXW': '^GSPC', 'NDX': '^NDX', 'VIX': '^VIX'}
+
+# Horizons ETFs, listed on the TSX only
+tsx_symbols = ['HXU', 'HXD', 'HQU', 'HQD', 'HEU', 'HED', 'HSU', 'HSD', 'HGU', 'HGD', 'HBU', 'HBD', 'HNU', 'HND', 'HOU', 'HOD', 'HCU', 'HCD']
+
+# futures roots whose Yahoo continuous contract isn't simply <root>=F; micros without their own
+# series use the full-size contract, which is quoted at the same price
+yahoo_futures = {'M6E': '6E=F', 'M6A': '6A=F', 'M6B': '6B=F', 'MJY': '6J=F', 'MSF': '6S=F', 'MCD': '6C=F',
+                 'MSI': 'SI=F', 'MHG': 'HG=F', 'MIR': None, 'MNH': None}
+
+class ibkr_source:
+    name = 'ibkr'
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    # IB takes the symbols as they come; broker_ibkr.get_stock does the mapping
+    def provider_symbol(self, symbol):
+        return symbol
+
+    async def download(self, symbol, end, duration, barlength):
+        return await self.driver.download_data_async(self.provider_symbol(symbol), end, duration, barlength)
+
+class alpaca_source:
+    name = 'alpaca'
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    # US stocks and ETFs only
+    def provider_symbol(self, symbol):
+        if self.driver.get_stock(symbol).is_futures:
+            raise Exception(f"Alpaca has no futures data for {symbol}")
+        if symbol in index_symbols:
+            raise Exception(f"Alpaca has no index data for {symbol}")
+        if symbol in tsx_symbols:
+            raise Exception(f"Alpaca has no TSX data for {symbol}")
+        if symbol in ['BRK-B', 'BRK/B']:
+            return 'BRK.B'
+        return symbol
+
+    async def download(self, symbol, end, duration, barlength):
+        symbol = self.provider_symbol(symbol)
+        # the Alpaca SDK is synchronous, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.driver.download_data, symbol, end, duration, barlength)
+
+class yahoo_source:
+    name = 'yahoo'
+
+    # only sizes whose bars line up with IB's: Yahoo's 1h bars start at :30, so there's no '1 hour'
+    intervals = {'1 min': '1m', '2 mins': '2m', '5 mins': '5m', '15 mins': '15m', '30 mins': '30m',
+                 '1 day': '1d', '1 week': '1wk', '1 month': '1mo'}
+
+    # driver is any broker driver; it's only used to classify the symbol and trim partial bars
+    def __init__(self, driver):
+        self.driver = driver
+
+    # futures as continuous contracts (ES -> ES=F), indices as ^ tickers, TSX listings as .TO
+    def provider_symbol(self, symbol):
+        root = symbol.replace('1!', '')
+        if self.driver.get_stock(symbol).is_futures:
+            ticker = yahoo_futures.get(root, root + '=F')
+            if ticker is None:
+                raise Exception(f"Yahoo has no futures data for {symbol}")
+            return ticker
+        if root in index_symbols:
+            return index_symbols[root]
+        if root in tsx_symbols:
+            return root + '.TO'
+        if root in ['BRK.B', 'BRK/B']:
+            return 'BRK-B'
+        return root
+
+    def download_sync(self, symbol, end, duration, barlength):
+        if barlength not in self.intervals:
+            raise Exception(f"Unsupported Yahoo bar size: {barlength}")
+        ticker = self.provider_symbol(symbol)
+        end_time = self.driver.parse_ib_end(end) or datetime.datetime.now() + datetime.timedelta(days=1)
+        start = end_time - self.driver.parse_ib_duration(duration)
+        # intraday bars include extended hours, like IB's (useRTH=False) and Alpaca's
+        intraday = 'min' in barlength
+        df = yf.Ticker(ticker).history(start=start, end=end_time, interval=self.intervals[barlength], auto_adjust=False, prepost=intraday)
+        if len(df) == 0:
+            raise Exception(f"Yahoo returned no data for {symbol} ({ticker}) {barlength}")
+        df = self.driver.normalize_bars(df, barlength)
+        return self.driver.trim_partial_bar(df, self.driver.get_stock(symbol), barlength)
+
+    async def download(self, symbol, end, duration, barlength):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.download_sync, symbol, end, duration, barlength)
+
+# stand-in provider for trying out hedged_fetch offline: answers with a fixed frame (or raises
+# a fixed exception) after the given delay in seconds
+class fake_source:
+    def __init__(self, name, delay, df=None, error=None):
+        self.name = name
+        self.delay = delay
+        self.df = df
+        self.error = error
+        self.calls = 0
+
+    def provider_symbol(self, symbol):
+        return symbol
+
+    async def download(self, symbol, end, duration, barlength):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.df
+
+# Send the same bar request to every source and return (source name, frame) from the first one to
+# succeed; the others are cancelled. Sources after the first are held back by hedge_delay seconds,
+# so with a healthy primary the backups are never asked. Raises if every source fails.
+#
+# example: await hedged_fetch([ibkr_source(ib), alpaca_source(al), yahoo_source(al)], 'SOXL', '', '1 Y', '1 day')
+async def hedged_fetch(sources, symbol, end, duration, barlength, hedge_delay=0):
+    async def attempt(i, source):
+        if i > 0 and hedge_delay > 0:
+            await asyncio.sleep(hedge_delay)
+        start = asyncio.get_event_loop().time()
+        df = await source.download(symbol, end, duration, barlength)
+        log.info("hedged_fetch.answer", source=source.name, symbol=symbol, barlength=barlength,
+                 bars=len(df), seconds=round(asyncio.get_event_loop().time() - start, 3))
+        return source.name, df
+
+    pending = {asyncio.ensure_future(attempt(i, source)) for i, source in enumerate(sources)}
+    errors = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+                log.warning("hedged_fetch.failed", symbol=symbol, barlength=barlength, error=str(task.exception()))
+    finally:
+        for task in pending:
+            task.cancel()
+
+    raise Exception(f"all data sources failed for {symbol} {barlength}: {errors}")
+
+def fetch_bars(sources, symbol, end, duration, barlength, hedge_delay=0):
+    name, df = asyncio.get_event_loop().run_until_complete(
+        hedged_fetch(sources, symbol, end, duration, barlength, hedge_delay=hedge_delay))
+    return df
+
+# race fake sources through hedged_fetch and check who wins; returns True if every case did as expected
+def self_test():
+    df = pd.DataFrame({'Open': [1.0], 'High': [1.0], 'Low': [1.0], 'Close': [1.0], 'Volume': [0]})
+    loop = asyncio.get_event_loop()
+    failed = 0
+
+    def check(name, ok, detail):
+        nonlocal failed
+        if not ok:
+            failed += 1
+        print(f"{'PASS' if ok else 'FAIL'}  {name}: {detail}")
+
+    def fetch(sources, hedge_delay=0):
+        start = time.perf_counter()
+        try:
+            winner = loop.run_until_complete(hedged_fetch(sources, 'SOXL', '', '1 D', '1 min', hedge_delay=hedge_delay))[0]
+        except Exception:
+            winner = None
+        return winner, time.perf_counter() - start
+
+    winner, seconds = fetch([fake_source('slow', 0.2, df), fake_source('fast', 0.05, df)])
+    check("fastest wins", winner == 'fast' and seconds < 0.15, f"{winner} after {seconds:.3f}s")
+
+    winner, seconds = fetch([fake_source('broken', 0.01, error=Exception("down")), fake_source('backup', 0.05, df)])
+    check("failure falls through", winner == 'backup', f"{winner} after {seconds:.3f}s")
+
+    backup = fake_source('backup', 0, df)
+    winner, seconds = fetch([fake_source('primary', 0.05, df), backup], hedge_delay=0.2)
+    check("hedge_delay holds the backup back", winner == 'primary' and backup.calls == 0,
+          f"{winner} after {seconds:.3f}s, backup asked {backup.calls}x")
+
+    winner, seconds = fetch([fake_source('primary', 0.5, df), fake_source('backup', 0, df)], hedge_delay=0.1)
+    check("backup answers after hedge_delay", winner == 'backup' and 0.1 <= seconds < 0.3, f"{winner} after {seconds:.3f}s")
+
+    winner, seconds = fetch([fake_source('a', 0, error=Exception("down")), fake_source('b', 0.01, error=Exception("down"))])
+    check("all failing raises", winner is None, f"{winner} after {seconds:.3f}s")
+
+    print(f"{5 - failed}/5 hedged_fetch cases as expected")
+    return failed == 0
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != '-t':
+        print("Usage: " + sys.argv[0] + " -t")
+        exit()
+    # keep the fake fetches out of the real event log
+    log.configure(path='data-sources-test-events.log')
+    sys.exit(0 if self_test() else 1)
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+#
+# Low-overhead structured event log for the order path.
+#
+# Callers hand over an event name plus a few primitive fields; the record goes into an
+# in-memory ring buffer and a background thread pickles batches of them to disk, so the
+# trading code never waits on terminal or file I/O. Decode a log offline with:
+#   python3 event_log.py trading-events.log
+
+import atexit
+import collections
+import configparser
+import datetime
+import pickle
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+level_values = {v.lower(): k for k, v in level_names.items()}
+
+event_log_cache = {}
+
+class event_log:
+    def __init__(self, path, level=INFO, echo_level=WARNING, capacity=65536, flush_interval=0.5):
+        self.path = path
+        self.level = level
+        self.echo_level = echo_level
+        self.flush_interval = flush_interval
+        # deque appends/pops are atomic, and with maxlen the oldest records get overwritten
+        # rather than blocking the producer if the writer ever falls behind
+        self.buffer = collections.deque(maxlen=capacity)
+        # overwritten only ever grows (bumped by producers), reported is the writer's high-water mark
+        self.overwritten = 0
+        self.reported = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        # the file and the writer thread only come into being with the first record, so merely
+        # importing a module that logs doesn't create a log file
+        self.file = None
+        self.writer = None
+        self.start_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    # point the log somewhere else (e.g. a tool's own file) and/or change its level; records
+    # already buffered still go to the old file
+    def configure(self, path=None, level=None):
+        if level is not None:
+            self.level = level
+        if path is not None and path != self.path:
+            with self.flush_lock:
+                self.write_batch(self.take_batch())
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                self.path = path
+
+    def log(self, level, event, **fields):
+        if level < self.level:
+            return
+        record = (time.time(), level, event, fields)
+        if len(self.buffer) == self.buffer.maxlen:
+            self.overwritten += 1
+        self.buffer.append(record)
+        if self.writer is None:
+            self.start_writer()
+        if level >= self.echo_level:
+            print(format_record(record))
+        if level >= ERROR:
+            self.wakeup.set()
+
+    def debug(self, event, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(ERROR, event, **fields)
+
+    def start_writer(self):
+        with self.start_lock:
+            if self.writer is None and not self.closed:
+                self.writer = threading.Thread(target=self.run_writer, name='event_log', daemon=True)
+                self.writer.start()
+                atexit.register(self.close)
+
+    def run_writer(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    # everything buffered so far, led by an event_log.dropped record if the ring buffer overwrote
+    # any records since the last batch
+    def take_batch(self):
+        batch = []
+        overwritten = self.overwritten
+        if overwritten > self.reported:
+            record = (time.time(), WARNING, 'event_log.dropped', {'count': overwritten - self.reported})
+            self.reported = overwritten
+            batch.append(record)
+            if WARNING >= self.echo_level:
+                print(format_record(record))
+        while True:
+            try:
+                batch.append(self.buffer.popleft())
+            except IndexError:
+                return batch
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            # pickle to bytes first so a record that can't be pickled never leaves half a batch in the file
+            try:
+                data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                batch = [(ts, level, event, {k: repr(v) for k, v in fields.items()}) for ts, level, event, fields in batch]
+                data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.file is None:
+                self.file = open(self.path, 'ab')
+            self.file.write(data)
+            self.file.flush()
+        except Exception as e:
+            # keep the writer alive; losing this batch is better than losing every later one
+            print(f"event_log: dropped {len(batch)} records, can't write {self.path}: {e}", file=sys.stderr)
+
+    def flush(self):
+        with self.flush_lock:
+            self.write_batch(self.take_batch())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+# shared log for the process, set up from the [DEFAULT] log-file / log-level settings in config.ini
+def get_event_log():
+    if 'log' not in event_log_cache:
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        path = config['DEFAULT'].get('log-file', 'trading-events.log')
+        level = level_values[config['DEFAULT'].get('log-level', 'info').lower()]
+        event_log_cache['log'] = event_log(path, level=level)
+    return event_log_cache['log']
+
+def format_record(record):
+    ts, level, event, fields = record
+    when = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    args = " ".join(f"{k}={v}" for k, v in fields.items())
+    return f"{when} {level_names.get(level, level):7} {event} {args}".rstrip()
+
+# read back a log file written by event_log, yielding one readable line per record; a last batch
+# cut short (e.g. by a crash mid-write) ends the output with a note instead of an exception
+def decode(path):
+    with open(path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                break
+            except pickle.UnpicklingError as e:
+                yield f"-- log truncated at byte {offset}: {e}"
+                break
+            for record in batch:
+                yield format_record(record)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: " + sys.argv[0] + " <event log file>")
+        exit()
+    for line in decode(sys.argv[1]):
+        print(line)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+#
+# Pre-market gate: probe every account at once and hold each call to a latency budget.
+#
+#   python3 health_check.py [bot]
+#
+# Checks the accounts of [bot-<bot>], or every account with a driver if no bot is given.
+# Each account probes its health-check-symbols, and any probe slower than its
+# health-check-max-ms fails; a probe (or connect) still running at that point is abandoned
+# as a TIMEOUT, so a hung call can't hold up the gate. Exit status is 1 if any probe failed.
+
+import asyncio
+import inspect
+import sys
+import threading
+import time
+
+from brokers import config, make_driver, bot_accounts
+
+# run a blocking probe on a daemon thread: one that hangs past its timeout is simply left
+# behind, where a default-executor thread would be waited for at exit
+def run_in_thread(probe):
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def settle(result, error):
+        if not future.done():
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run():
+        try:
+            result = probe()
+        except Exception as e:
+            loop.call_soon_threadsafe(settle, None, e)
+        else:
+            loop.call_soon_threadsafe(settle, result, None)
+
+    threading.Thread(target=run, name='health_probe', daemon=True).start()
+    return future
+
+async def run_probe(account, name, probe, max_ms):
+    start = time.perf_counter()
+    error = None
+    try:
+        if inspect.iscoroutinefunction(probe):
+            await asyncio.wait_for(probe(), max_ms / 1000)
+        else:
+            await asyncio.wait_for(run_in_thread(probe), max_ms / 1000)
+    except asyncio.TimeoutError:
+        error = 'TIMEOUT'
+    except Exception as e:
+        error = str(e)
+    return {'account': account, 'probe': name, 'ms': (time.perf_counter() - start) * 1000, 'max_ms': max_ms, 'error': error}
+
+# connect one account and run its probes; the connect itself is timed as the 'connect' probe
+async def check_account(bot, account):
+    max_ms = float(config[account].get('health-check-max-ms', '2000'))
+
+    start = time.perf_counter()
+    try:
+        driver = make_driver(bot, account)
+        await asyncio.wait_for(driver.load_conn_async(), max_ms / 1000)
+        account_probes = driver.health_probes(driver.health_check_symbols())
+        error = None
+    except asyncio.TimeoutError:
+        account_probes = []
+        error = 'TIMEOUT'
+    except Exception as e:
+        account_probes = []
+        error = str(e)
+    results = [{'account': account, 'probe': 'connect', 'ms': (time.perf_counter() - start) * 1000, 'max_ms': max_ms, 'error': error}]
+
+    results += await asyncio.gather(*[run_probe(account, name, probe, max_ms) for name, probe in account_probes])
+    return results
+
+# every account connects and probes at once, so the gate takes as long as the slowest account
+async def run_health_checks(accounts, bot='live'):
+    per_account = await asyncio.gather(*[check_account(bot, account) for account in accounts])
+    return [r for results in per_account for r in results]
+
+def report(results, wall_ms):
+    failed = 0
+    for r in results:
+        if r['error'] == 'TIMEOUT':
+            status = f"TIMEOUT  gave up after {r['max_ms']:.0f}ms"
+        elif r['error'] is not None:
+            status = f"FAIL  {r['error']}"
+        elif r['ms'] > r['max_ms']:
+            status = f"SLOW  over {r['max_ms']:.0f}ms"
+        else:
+            status = "PASS"
+        if status != "PASS":
+            failed += 1
+        print(f"{r['account']:12} {r['probe']:20} {r['ms']:8.1f}ms  {status}")
+
+    print(f"{'PASS' if failed == 0 else 'FAIL'}: {len(results) - failed}/{len(results)} probes ok, {wall_ms:.0f}ms total")
+    return failed == 0
+
+if __name__ == '__main__':
+    bot = sys.argv[1] if len(sys.argv) >= 2 else None
+    start = time.perf_counter()
+    results = asyncio.get_event_loop().run_until_complete(run_health_checks(bot_accounts(bot), bot or 'live'))
+    ok = report(results, (time.perf_counter() - start) * 1000)
+    sys.exit(0 if ok else 1)
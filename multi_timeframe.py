@@ -0,0 +1,120 @@
+import time
+
+import pandas as pd
+from event_log import get_event_log
+
+log = get_event_log()
+
+bar_cache = {}
+
+# seconds per unit of an IB bar size, used to order bar sizes and check which divide which
+bar_unit_seconds = {'sec': 1, 'min': 60, 'hour': 3600, 'day': 86400, 'week': 7*86400, 'month': 31*86400}
+
+ohlcv = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+# split an IB bar size like '5 mins' or '1 hour' into (5, 'min') / (1, 'hour')
+def parse_barlength(barlength):
+    n, unit = barlength.split(' ')
+    unit = unit.rstrip('s')
+    if unit not in bar_unit_seconds:
+        raise Exception(f"Unknown bar size: {barlength}")
+    return int(n), unit
+
+def bar_seconds(barlength):
+    n, unit = parse_barlength(barlength)
+    return n * bar_unit_seconds[unit]
+
+# day/week/month bars are downloaded with useRTH=True, everything shorter includes extended hours
+def is_rth_bar(barlength):
+    return parse_barlength(barlength)[1] in ['day', 'week', 'month']
+
+# resample OHLCV bars to a coarser bar size in one vectorized pass
+def resample_bars(df, barlength, rth_only=False):
+    n, unit = parse_barlength(barlength)
+    if rth_only:
+        df = df.iloc[df.index.indexer_between_time('09:30', '16:00', include_end=False)]
+
+    if unit == 'sec':
+        bins = df.resample(f"{n}s")
+    elif unit == 'min':
+        bins = df.resample(f"{n}min")
+    elif unit == 'hour':
+        bins = df.resample(f"{n}h")
+    elif unit == 'day':
+        bins = df.resample(f"{n}D")
+    elif unit == 'week':
+        # weeks start on Monday and are labelled with that date
+        bins = df.resample(f"{n}W-MON", label='left', closed='left')
+    else:
+        bins = df.resample(f"{n}MS")
+
+    return bins.agg(ohlcv).dropna(subset=['Open'])
+
+# Serves several bar sizes for a symbol from as few IB downloads as possible: the finest
+# bar size is downloaded once and the coarser ones are built from it locally.
+#
+# example: multi_timeframe(broker_ibkr('live', account)).get_bars('SOXL', '', '1 Y', ['1 hour', '1 day', '1 week'])
+class multi_timeframe:
+    def __init__(self, driver, cache_seconds=300):
+        self.driver = driver
+        self.cache_seconds = cache_seconds
+
+    # can bars of size target be built from bars of size base?
+    def can_derive(self, base, target, stock):
+        if base == target:
+            return True
+        if bar_seconds(base) > bar_seconds(target):
+            return False
+        base_n, base_unit = parse_barlength(base)
+        if is_rth_bar(base):
+            # a single day tiles weeks and months; multi-day bars don't
+            return is_rth_bar(target) and base_unit == 'day' and base_n == 1
+        if not is_rth_bar(target):
+            return bar_seconds(target) % bar_seconds(base) == 0
+        # RTH bars from extended-hours intraday bars: only for stocks, and only if the intraday
+        # bars line up with the 9:30 open so we can cut out the regular session exactly
+        return not stock.is_futures and 1800 % bar_seconds(base) == 0
+
+    def get_bars(self, symbol, end, duration, barlengths):
+        log.info("get_bars", symbol=symbol, end=end, duration=duration, barlengths=",".join(barlengths))
+        result = {}
+        missing = []
+        for barlength in barlengths:
+            key = (symbol, end, duration, barlength)
+            if key in bar_cache and time.time() - bar_cache[key]['time'] < self.cache_seconds:
+                result[barlength] = bar_cache[key]['df']
+            else:
+                missing.append(barlength)
+        if not missing:
+            return result
+
+        stock = self.driver.get_stock(symbol, forhistory=True)
+
+        # pick the bar sizes to actually download, finest first, reusing one wherever it divides a coarser size
+        plan = {}
+        bases = []
+        for barlength in sorted(set(missing), key=bar_seconds):
+            base = next((b for b in bases if self.can_derive(b, barlength, stock)), None)
+            if base is None:
+                bases.append(barlength)
+                base = barlength
+            plan[barlength] = base
+
+        # download untrimmed and trim each result once for its own bar size, so a derived week
+        # still holds today's partial session the way IB's own weekly bar does
+        downloads = {}
+        for base in bases:
+            downloads[base] = self.driver.download_data(symbol, end, duration, base, trim=False)
+
+        for barlength, base in plan.items():
+            if base == barlength:
+                df = downloads[base]
+            else:
+                rth_only = is_rth_bar(barlength) and not is_rth_bar(base)
+                df = resample_bars(downloads[base], barlength, rth_only=rth_only)
+            df = self.driver.trim_partial_bar(df, stock, barlength)
+            bar_cache[(symbol, end, duration, barlength)] = {'df': df, 'time': time.time()}
+            result[barlength] = df
+
+        log.info("get_bars.done", symbol=symbol, downloads=",".join(bases), derived=len(plan) - len(bases))
+        return result
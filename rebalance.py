@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#
+# Move every account of a bot to a set of target portfolio weights in one go.
+#
+#   python3 rebalance.py <bot> SOXL=0.5 TQQQ=-0.3 [--dry-run]
+#
+# A weight is the fraction of an account's net liquidity to hold in that symbol (negative is short).
+# Per account it's scaled by 'multiplier', or replaced by '<SYMBOL>-pct' where that's set, and with
+# use-inverse-etf a short in a symbol from [inverse-etfs] becomes a long in its inverse ETF instead.
+# Sells go out before buys so they free up the cash.
+
+import asyncio
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from brokers import config, make_driver, bot_accounts
+from event_log import get_event_log
+
+log = get_event_log()
+
+# long -> inverse ETF map; configparser lowercases keys and mixes in [DEFAULT], so undo both
+def inverse_etfs():
+    if not config.has_section('inverse-etfs'):
+        return {}
+    return {k.upper(): v.strip() for k, v in config['inverse-etfs'].items() if k not in config.defaults()}
+
+# effective weights per account (rows) and symbol (columns), after multiplier, pct and inverse-ETF rules;
+# an inverse ETF that wasn't asked for is NaN (no target, leave the position alone) on accounts
+# without use-inverse-etf
+def account_weights(accounts, weights):
+    inverse = {k: v for k, v in inverse_etfs().items() if k in weights}
+    extra = [v for v in inverse.values() if v not in weights]
+    symbols = list(weights) + extra
+
+    w = pd.DataFrame([[weights.get(s, 0.0) for s in symbols]] * len(accounts), index=accounts, columns=symbols, dtype=float)
+    multiplier = pd.Series([float(config[a].get('multiplier', '1.0')) for a in accounts], index=accounts)
+    pct = pd.DataFrame([[float(config[a][f"{s}-pct"]) if f"{s}-pct" in config[a] else np.nan for s in symbols] for a in accounts],
+                       index=accounts, columns=symbols)
+
+    weights = pd.DataFrame(np.where(pct.notna(), np.sign(w) * pct / 100, w.mul(multiplier, axis=0)), index=accounts, columns=symbols)
+
+    uses_inverse = pd.Series([config[a].get('use-inverse-etf', 'no') == 'yes' for a in accounts], index=accounts)
+    for long, short in inverse.items():
+        flip = uses_inverse & (weights[long] < 0)
+        # on top of any weight the inverse ETF already has of its own
+        weights.loc[flip, short] += -weights.loc[flip, long]
+        weights.loc[flip, long] = 0.0
+    weights.loc[~uses_inverse, extra] = np.nan
+    return weights
+
+async def rebalance(bot, weights, accounts=None, dry_run=False):
+    timings = {}
+    start = time.perf_counter()
+    if accounts is None:
+        accounts = bot_accounts(bot)
+    drivers = {account: make_driver(bot, account) for account in accounts}
+    timings['connect'] = time.perf_counter() - start
+
+    # fetch: net liquidity and positions for every account, and one quote per symbol per broker, all at once
+    start = time.perf_counter()
+    symbols = list(account_weights(accounts, weights).columns)
+    broker = {account: type(driver).__name__ for account, driver in drivers.items()}
+    quoters = {}
+    for account, driver in drivers.items():
+        quoters.setdefault(broker[account], driver)
+    quotes = [(kind, symbol) for kind in quoters for symbol in symbols]
+
+    results = await asyncio.gather(
+        *[drivers[a].get_net_liquidity_async() for a in accounts],
+        *[drivers[a].get_positions_async(symbols) for a in accounts],
+        *[quoters[kind].get_price_async(symbol) for kind, symbol in quotes], return_exceptions=True)
+    net_liquidity = dict(zip(accounts, results[:len(accounts)]))
+    positions = dict(zip(accounts, results[len(accounts):2 * len(accounts)]))
+    quote = dict(zip(quotes, results[2 * len(accounts):]))
+    timings['fetch'] = time.perf_counter() - start
+
+    # an account whose balance or positions couldn't be read sits this one out; a failed quote
+    # is just a missing price, which leaves its orders unpriced below
+    failed = {a: r for a in accounts for r in [net_liquidity[a], positions[a]] if isinstance(r, Exception)}
+    for account, error in failed.items():
+        log.error("rebalance.account_failed", account=account, error=str(error))
+    for (kind, symbol), result in quote.items():
+        if isinstance(result, Exception):
+            log.warning("rebalance.quote_failed", broker=kind, symbol=symbol, error=str(result))
+            quote[(kind, symbol)] = np.nan
+    accounts = [a for a in accounts if a not in failed]
+    target = account_weights(accounts, weights)
+    net_liquidity = pd.Series([net_liquidity[a] for a in accounts], index=accounts, dtype=float)
+    positions = pd.DataFrame([positions[a] for a in accounts], index=accounts, columns=symbols, dtype=float)
+
+    # compute: every account's share deltas in one pass
+    start = time.perf_counter()
+    prices = pd.DataFrame([[quote[(broker[a], s)] for s in symbols] for a in accounts], index=accounts, columns=symbols, dtype=float)
+    prices = prices.replace(0, np.nan)
+    shares = np.fix(target.mul(net_liquidity, axis=0) / prices).where(target != 0, 0.0)
+    # no target (NaN) means the position is left as it is, like any holding not in the request
+    deltas = (shares - positions).where(target.notna(), 0.0)
+    # no quote means no order, including closing out a position whose target is 0
+    unpriced = (prices.isna() & (deltas != 0)).stack()
+    unpriced = unpriced[unpriced]
+    deltas = deltas.where(prices.notna(), 0).stack()
+    deltas = deltas[deltas != 0]
+    orders = [(account, symbol, int(delta), prices.at[account, symbol]) for (account, symbol), delta in deltas.items()]
+    timings['compute'] = time.perf_counter() - start
+
+    for account, symbol in unpriced.index:
+        log.error("rebalance.no_price", account=account, symbol=symbol)
+
+    # submit: all sells in parallel, then all buys
+    outcome = {}
+    for phase, batch in [('sells', [o for o in orders if o[2] < 0]), ('buys', [o for o in orders if o[2] > 0])]:
+        start = time.perf_counter()
+        if not dry_run and batch:
+            done = await asyncio.gather(*[drivers[a].place_variation(s, d, price=p) for a, s, d, p in batch], return_exceptions=True)
+            for (a, s, d, p), result in zip(batch, done):
+                outcome[(a, s)] = result
+        timings[phase] = time.perf_counter() - start
+
+    log.info("rebalance", bot=bot, accounts=len(accounts), orders=len(orders), dry_run=dry_run,
+             **{f"{phase}_ms": round(t * 1000, 1) for phase, t in timings.items()})
+    return {'orders': orders, 'outcome': outcome, 'unpriced': list(unpriced.index), 'failed': failed, 'timings': timings}
+
+def report(result, dry_run=False):
+    for account, symbol, delta, price in result['orders']:
+        error = result['outcome'].get((account, symbol))
+        status = "dry run" if dry_run else ("FAIL " + str(error) if isinstance(error, Exception) else "ok")
+        print(f"{account:12} {'BUY' if delta > 0 else 'SELL':4} {abs(delta):8} {symbol:8} @ {price:10.2f}  {status}")
+    for account, symbol in result['unpriced']:
+        print(f"{account:12} no price for {symbol}, skipped")
+    for account, error in result['failed'].items():
+        print(f"{account:12} skipped: {error}")
+    print("  ".join(f"{phase} {t * 1000:.1f}ms" for phase, t in result['timings'].items()))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: " + sys.argv[0] + " <bot> SYMBOL=weight [SYMBOL=weight ...] [--dry-run]")
+        exit()
+    dry_run = '--dry-run' in sys.argv
+    weights = {}
+    for param in sys.argv[2:]:
+        if param != '--dry-run':
+            symbol, weight = param.split('=')
+            weights[symbol.upper()] = float(weight)
+    result = asyncio.get_event_loop().run_until_complete(rebalance(sys.argv[1], weights, dry_run=dry_run))
+    report(result, dry_run)
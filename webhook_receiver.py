@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+#
+# Receives TradingView strategy alerts (the JSON payload in config-template.ini) and drives
+# set_position_size on every account of the alert's bot.
+#
+#   python3 webhook_receiver.py              serve on webhook-host/webhook-port from config.ini
+#   python3 webhook_receiver.py loadtest [n] fire n alerts at a local receiver with stand-in drivers
+#
+# The alert is acknowledged as soon as it validates; the orders are placed afterwards, one task per
+# account, all running concurrently. Each account's size is scaled by its multiplier, or replaced by
+# its <SYMBOL>-pct of net liquidity, and with use-inverse-etf a short becomes a long in the inverse
+# ETF, the same rules rebalance.py applies. Orders for the same account and symbol go one at a time, and
+# only the newest target waiting in line is placed.
+
+import asyncio
+import collections
+import hmac
+import json
+import sys
+import time
+
+import numpy as np
+
+import brokers
+import rebalance
+from event_log import get_event_log
+
+log = get_event_log()
+
+# the fields we rely on, checked once per alert; anything else in the payload is ignored
+alert_schema = {
+    'passphrase': str,
+    'ticker': str,
+    'strategy': {
+        'bot': str,
+        'market_position': str,
+        'market_position_size': (int, float),
+    },
+}
+
+# flatten the schema into (path, types) checks once at import, so validating an alert is a flat loop
+def compile_schema(schema, path=()):
+    checks = []
+    for key, spec in schema.items():
+        if isinstance(spec, dict):
+            checks.append((path + (key,), dict))
+            checks += compile_schema(spec, path + (key,))
+        else:
+            checks.append((path + (key,), spec))
+    return checks
+
+alert_checks = compile_schema(alert_schema)
+
+# returns None if the alert is well-formed, otherwise what's wrong with it
+def validate_alert(alert):
+    if not isinstance(alert, dict):
+        return "payload is not an object"
+    for path, types in alert_checks:
+        value = alert
+        for key in path[:-1]:
+            value = value[key]
+        if path[-1] not in value:
+            return f"missing {'.'.join(path)}"
+        value = value[path[-1]]
+        if not isinstance(value, types) or isinstance(value, bool):
+            return f"bad type for {'.'.join(path)}"
+    return None
+
+# signed target size from TradingView's market_position ('long', 'short' or 'flat') and size
+def target_size(strategy):
+    if strategy['market_position'] == 'flat':
+        return 0
+    if strategy['market_position'] == 'short':
+        return -abs(strategy['market_position_size'])
+    return abs(strategy['market_position_size'])
+
+# an account's target positions for an alert of size shares in symbol, as {symbol: shares}. A plain
+# multiplier just scales the size; <SYMBOL>-pct and use-inverse-etf are dollar rules, so those
+# accounts go through rebalance.account_weights with the size as a fraction of their net liquidity
+async def account_targets(driver, account, symbol, size):
+    aconfig = brokers.config[account]
+    uses_inverse = aconfig.get('use-inverse-etf', 'no') == 'yes' and symbol in rebalance.inverse_etfs()
+    if f"{symbol}-pct" not in aconfig and not uses_inverse:
+        return {symbol: int(np.fix(size * float(aconfig.get('multiplier', '1.0'))))}
+
+    net_liquidity, price = await asyncio.gather(driver.get_net_liquidity_async(), driver.get_price_async(symbol))
+    if not price or not net_liquidity:
+        raise Exception(f"can't size {symbol} for {account}: price {price}, net liquidity {net_liquidity}")
+    weights = rebalance.account_weights([account], {symbol: size * price / net_liquidity}).loc[account]
+
+    targets = {}
+    for s, weight in weights.items():
+        if np.isnan(weight):
+            continue
+        if weight == 0:
+            targets[s] = 0
+            continue
+        s_price = price if s == symbol else await driver.get_price_async(s)
+        if not s_price:
+            raise Exception(f"can't size {s} for {account}: no price")
+        # rounded first so a multiplier's size * price / nlv * nlv / price doesn't lose a share to float error
+        targets[s] = int(np.fix(round(weight * net_liquidity / s_price, 6)))
+    return targets
+
+# no scaling, for the load test's stand-in accounts
+async def unscaled_targets(driver, account, symbol, size):
+    return {symbol: size}
+
+class webhook_receiver:
+    def __init__(self, password, make_driver=brokers.make_driver, bot_accounts=brokers.bot_accounts, account_targets=account_targets):
+        self.password = password.encode()
+        self.make_driver = make_driver
+        self.bot_accounts = bot_accounts
+        self.account_targets = account_targets
+        self.drivers = {}
+        self.tasks = set()
+        self.locks = collections.defaultdict(asyncio.Lock)
+        self.latest = {}
+
+    def get_driver(self, bot, account):
+        if (bot, account) not in self.drivers:
+            self.drivers[(bot, account)] = self.make_driver(bot, account)
+        return self.drivers[(bot, account)]
+
+    # check an alert body and, if it's good, start placing its orders; returns (http status, text)
+    def handle_alert(self, body, received):
+        try:
+            alert = json.loads(body)
+        except ValueError:
+            return 400, "invalid json"
+        error = validate_alert(alert)
+        if error is not None:
+            return 400, error
+        if not hmac.compare_digest(alert['passphrase'].encode(), self.password):
+            log.warning("webhook.bad_passphrase", ticker=alert['ticker'])
+            return 403, "bad passphrase"
+
+        bot = alert['strategy']['bot']
+        try:
+            accounts = self.bot_accounts(bot)
+        except KeyError:
+            return 404, f"unknown bot {bot}"
+
+        task = asyncio.ensure_future(self.fan_out(bot, accounts, alert['ticker'], target_size(alert['strategy']), received))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return 200, "ok"
+
+    async def fan_out(self, bot, accounts, symbol, size, received):
+        log.info("webhook.alert", bot=bot, symbol=symbol, size=size, accounts=len(accounts))
+        results = await asyncio.gather(*[self.set_position_size(bot, account, symbol, size, received) for account in accounts],
+                                       return_exceptions=True)
+        for account, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                log.error("webhook.order_failed", bot=bot, account=account, symbol=symbol, error=str(result))
+
+    # a duplicate alert waits for the first one's order and then finds the position already at
+    # target; of several alerts queued behind an order only the last is placed, the rest are stale
+    async def set_position_size(self, bot, account, symbol, size, received):
+        driver = self.get_driver(bot, account)
+        key = (account, symbol)
+        self.latest[key] = received
+        async with self.locks[key]:
+            if self.latest[key] != received:
+                log.info("webhook.superseded", account=account, symbol=symbol, size=size)
+                return
+            targets = await self.account_targets(driver, account, symbol, size)
+            log.info("webhook.submit", account=account, symbol=symbol, size=size, targets=str(targets),
+                     ms=round((time.perf_counter() - received) * 1000, 2))
+            # positions being closed go first, so e.g. SOXS is sold before SOXL is bought with the cash
+            for s, shares in sorted(targets.items(), key=lambda t: t[1] != 0):
+                await driver.set_position_size(s, shares)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                received = time.perf_counter()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', '0'))
+                if length > 65536:
+                    status, text = 413, "payload too large"
+                    await self.respond(writer, status, text, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                if not request_line.startswith(b'POST '):
+                    status, text = 405, "POST only"
+                else:
+                    status, text = self.handle_alert(body, received)
+
+                close = headers.get('connection', '').lower() == 'close'
+                await self.respond(writer, status, text, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, text, close):
+        reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+        body = text.encode()
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        log.info("webhook.listening", host=host, port=port)
+        return server
+
+# stand-in driver for the load test, so no orders go anywhere
+class loadtest_driver:
+    def __init__(self, bot, account):
+        pass
+
+    async def set_position_size(self, symbol, amount):
+        pass
+
+async def loadtest(n, connections=10, accounts=3):
+    password = 'loadtest'
+    receiver = webhook_receiver(password, make_driver=loadtest_driver, bot_accounts=lambda bot: [f"acct{i}" for i in range(accounts)],
+                                account_targets=unscaled_targets)
+    server = await receiver.serve('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # time from receipt to driver call, taken from the receiver's own measurement
+    submit_ms = []
+    original = receiver.set_position_size
+    async def timed(bot, account, symbol, size, received):
+        submit_ms.append((time.perf_counter() - received) * 1000)
+        await original(bot, account, symbol, size, received)
+    receiver.set_position_size = timed
+
+    payload = json.dumps({'ticker': 'SOXL', 'passphrase': password,
+                          'strategy': {'bot': 'live', 'market_position': 'long', 'market_position_size': 100}}).encode()
+    request = b"POST /webhook HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: " + \
+        str(len(payload)).encode() + b"\r\n\r\n" + payload
+
+    async def client(count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for i in range(count):
+            writer.write(request)
+            await writer.drain()
+            await reader.readuntil(b"\r\n\r\n")
+            await reader.readexactly(2)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n // connections) for i in range(connections)])
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*receiver.tasks)
+    server.close()
+
+    sent = (n // connections) * connections
+    submit_ms.sort()
+    print(f"{sent} alerts in {elapsed:.2f}s: {sent / elapsed:.0f} req/s over {connections} connections, {accounts} accounts each")
+    print(f"time to order submission: p50 {submit_ms[len(submit_ms) // 2]:.2f}ms  p99 {submit_ms[int(len(submit_ms) * 0.99)]:.2f}ms  max {submit_ms[-1]:.2f}ms")
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    if len(sys.argv) >= 2 and sys.argv[1] == 'loadtest':
+        # keep the synthetic alerts out of the real event log
+        log.configure(path='webhook-loadtest-events.log')
+        loop.run_until_complete(loadtest(int(sys.argv[2]) if len(sys.argv) >= 3 else 10000))
+    else:
+        defaults = brokers.config['DEFAULT']
+        receiver = webhook_receiver(defaults['signals-password'])
+        loop.run_until_complete(receiver.serve(defaults.get('webhook-host', '0.0.0.0'), int(defaults.get('webhook-port', '5000'))))
+        loop.run_forever()